@@ -127,10 +127,13 @@ def store_masked_loaders(train_dataset: Dataset, test_dataset: Dataset,
     if hasattr(test_dataset, 'data_path'):
         test_dataset.data_path = np.array(test_dataset.data_path)[test_mask]
 
+    pin_memory = torch.cuda.is_available()
     train_loader = DataLoader(train_dataset,
-                              batch_size=setting.args.batch_size, shuffle=True, num_workers=4)
+                              batch_size=setting.args.batch_size, shuffle=True,
+                              num_workers=4, pin_memory=pin_memory)
     test_loader = DataLoader(test_dataset,
-                             batch_size=setting.args.batch_size, shuffle=False, num_workers=4)
+                             batch_size=setting.args.batch_size, shuffle=False,
+                             num_workers=4, pin_memory=pin_memory)
     setting.test_loaders.append(test_loader)
     setting.train_loader = train_loader
 
@@ -191,7 +191,8 @@ class CoPE3SER(CLModel2Branches):
                 loss.backward()
                 self.opt.step()
 
-            self.autolog_wandb(locals())
+            # no per-iteration wandb logging: it advances the run's global
+            # step and would clobber the per-task logs done in train()
             overall_loss += loss.item()
 
             if update:
@@ -56,6 +56,8 @@ def add_management_args(parser: ArgumentParser) -> None:
     parser.add_argument('--ignore_other_metrics', default=0, choices=[0, 1], type=int,
                         help='disable additional metrics')
     parser.add_argument('--debug_mode', type=int, default=0, help='Run only a few forward steps per epoch')
+    parser.add_argument('--prog_interval', type=int, default=10,
+                        help='Update the progress bar every N iterations')
     parser.add_argument('--nowand', default=0, choices=[0, 1], type=int, help='Inhibit wandb logging')
     parser.add_argument('--wandb_entity', type=str, help='Wandb entity')
     parser.add_argument('--wandb_project', type=str, help='Wandb project name')
@@ -63,6 +65,13 @@ def add_management_args(parser: ArgumentParser) -> None:
 
     parser.add_argument('--savecheck', action='store_true',
                         help='Whether to save checkpoint')
+    parser.add_argument('--compile', action='store_true',
+                        help='Compile the networks with torch.compile')
+    parser.add_argument('--amp', action='store_true',
+                        help='Run forward passes under bfloat16 autocast')
+    parser.add_argument('--gpu_residency', action='store_true',
+                        help='Keep the whole task dataset on GPU '
+                             '(augmentations are sampled once per task)')
     parser.add_argument('--sal_ckpt', type=str, default=None)
     parser.add_argument('--class_ckpt', type=str, default=None)
     parser.add_argument('--dataset_path', type=str, default=base_path())
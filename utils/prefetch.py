@@ -0,0 +1,131 @@
+import torch
+
+
+class CUDAPrefetcher:
+    """
+    Wraps a DataLoader and uploads the next batch on a dedicated CUDA
+    stream while the current batch is being processed, so the
+    host-to-device copy overlaps with compute instead of stalling it.
+    Mirrors the NVIDIA apex imagenet prefetcher.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def _to_device(self, batch):
+        if isinstance(batch, (list, tuple)):
+            return [self._to_device(b) for b in batch]
+        if torch.is_tensor(batch):
+            return batch.to(self.device, non_blocking=True)
+        return batch
+
+    def _record_stream(self, batch):
+        if isinstance(batch, (list, tuple)):
+            for b in batch:
+                self._record_stream(b)
+        elif torch.is_tensor(batch):
+            batch.record_stream(torch.cuda.current_stream())
+
+    def _preload(self):
+        try:
+            batch = next(self._iter)
+        except StopIteration:
+            self._next = None
+            return
+        with torch.cuda.stream(self.stream):
+            self._next = self._to_device(batch)
+
+    def __iter__(self):
+        self._iter = iter(self.loader)
+        self._preload()
+        return self
+
+    def __next__(self):
+        if self._next is None:
+            raise StopIteration
+        torch.cuda.current_stream().wait_stream(self.stream)
+        batch = self._next
+        self._record_stream(batch)
+        self._preload()
+        return batch
+
+
+class GPUResidentLoader:
+    """
+    Materializes a whole (small) task dataset on the GPU by iterating the
+    wrapped DataLoader once, then serves index-sliced batches directly
+    from device memory, so no PCIe copy is paid after the first epoch.
+    Transforms run on CPU during materialization only: train-time random
+    augmentations are sampled once per task.
+    """
+
+    def __init__(self, loader, device, shuffle):
+        self.dataset = loader.dataset
+        self.batch_size = loader.batch_size
+        self.device = device
+        self.shuffle = shuffle
+        fields = None
+        for batch in loader:
+            if fields is None:
+                fields = [[] for _ in batch]
+            for field, part in zip(fields, batch):
+                field.append(part)
+        self.fields = [self._cat(parts) for parts in fields]
+        first = self.fields[0]
+        self.n_examples = (first[0] if isinstance(first, list) else first).shape[0]
+
+    def _cat(self, parts):
+        if isinstance(parts[0], (list, tuple)):
+            return [torch.cat([p[j] for p in parts]).to(self.device)
+                    for j in range(len(parts[0]))]
+        return torch.cat(parts).to(self.device)
+
+    def __len__(self):
+        return (self.n_examples + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if self.shuffle:
+            idx = torch.randperm(self.n_examples, device=self.device)
+        else:
+            idx = torch.arange(self.n_examples, device=self.device)
+        for start in range(0, self.n_examples, self.batch_size):
+            sel = idx[start:start + self.batch_size]
+            yield [[sub[sel] for sub in field] if isinstance(field, list)
+                   else field[sel] for field in self.fields]
+
+
+def gpu_resident_loader(loader, device, shuffle):
+    """
+    Returns a GPUResidentLoader built from the given loader, reusing it
+    as-is if residency was already applied.
+    :param loader: the DataLoader to be materialized on device
+    :param device: the target device
+    :param shuffle: whether batches are drawn in a new random order each epoch
+    :return: a loader yielding device-resident batches
+    """
+    if isinstance(loader, GPUResidentLoader):
+        return loader
+    return GPUResidentLoader(loader, device, shuffle)
+
+
+def maybe_prefetch(loader, device):
+    """
+    Returns a CUDAPrefetcher around the given loader when running on GPU,
+    the loader itself otherwise.
+    :param loader: the DataLoader to be wrapped
+    :param device: the target device
+    :return: a loader yielding device-resident batches
+    """
+    if torch.cuda.is_available() and \
+            not isinstance(loader, (CUDAPrefetcher, GPUResidentLoader)):
+        return CUDAPrefetcher(loader, device)
+    return loader
@@ -3,20 +3,22 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import contextlib
 import math
+import os
 import sys
 from argparse import Namespace
 from typing import Tuple
 
 import torch
-from datasets import get_dataset
 from datasets.utils.continual_dataset import ContinualDataset
 from models.utils.continual_model import ContinualModel
 
 from utils.loggers import *
+from utils.prefetch import gpu_resident_loader, maybe_prefetch
 from utils.status import ProgressBar
 from utils.saliency_metrics import compute_saliency_metrics
-import pickle
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 try:
     import wandb
@@ -24,6 +26,28 @@ except ImportError:
     wandb = None
 
 
+_task_masks = {}
+
+
+def get_task_mask(dataset: ContinualDataset, k: int, device) -> torch.Tensor:
+    """
+    Returns the boolean mask selecting the classes of every task but the
+    k-th one, caching it so each (task, shape, device) builds it once.
+    :param dataset: the continual dataset
+    :param k: the task index
+    :param device: the device of the outputs to be masked
+    :return: the boolean mask over the first N_TASKS * N_CLASSES_PER_TASK classes
+    """
+    key = (k, dataset.N_CLASSES_PER_TASK, dataset.N_TASKS, device)
+    mask = _task_masks.get(key)
+    if mask is None:
+        cpt = dataset.N_CLASSES_PER_TASK
+        mask = torch.ones(dataset.N_TASKS * cpt, dtype=torch.bool, device=device)
+        mask[k * cpt:(k + 1) * cpt] = False
+        _task_masks[key] = mask
+    return mask
+
+
 def mask_classes(outputs: torch.Tensor, dataset: ContinualDataset, k: int) -> None:
     """
     Given the output tensor, the dataset at hand and the current task,
@@ -33,9 +57,51 @@ def mask_classes(outputs: torch.Tensor, dataset: ContinualDataset, k: int) -> No
     :param dataset: the continual dataset
     :param k: the task index
     """
-    outputs[:, 0:k * dataset.N_CLASSES_PER_TASK] = -float('inf')
-    outputs[:, (k + 1) * dataset.N_CLASSES_PER_TASK:
-               dataset.N_TASKS * dataset.N_CLASSES_PER_TASK] = -float('inf')
+    mask = get_task_mask(dataset, k, outputs.device)
+    outputs[:, :mask.shape[0]].masked_fill_(mask, -float('inf'))
+
+
+def buffer_state_dict(buffer) -> dict:
+    """
+    Exports the replay buffer as a dict of CPU tensors plus its sample
+    counter. torch.save writes plain tensors as raw storages inside its
+    zipfile, so this skips the generic object-pickle path entirely; each
+    tensor crosses the PCIe bus exactly once.
+    :param buffer: the memory buffer to export
+    :return: a dict with the buffer's tensor attributes and counters
+    """
+    # copy=True: on a CPU run .to('cpu') would alias the live tensors,
+    # which the saver thread must never share with the training loop
+    state = {attr_str: getattr(buffer, attr_str).detach().to('cpu', non_blocking=True, copy=True)
+             for attr_str in buffer.attributes if hasattr(buffer, attr_str)}
+    state['num_seen_examples'] = buffer.num_seen_examples
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return state
+
+
+def to_channels_last(inputs):
+    """
+    Converts 4D image batches (handling list-valued inputs element-wise)
+    to the channels-last memory format; anything else is left untouched.
+    :param inputs: a batch tensor or a list of batch tensors
+    :return: the batch in channels-last format where applicable
+    """
+    if isinstance(inputs, list):
+        return [to_channels_last(inp) for inp in inputs]
+    if torch.is_tensor(inputs) and inputs.dim() == 4:
+        return inputs.contiguous(memory_format=torch.channels_last)
+    return inputs
+
+
+def uncompiled(net: torch.nn.Module) -> torch.nn.Module:
+    """
+    Returns the original module wrapped by torch.compile, if any.
+    Needed to keep the saved state_dicts free of the '_orig_mod.' prefix.
+    :param net: a (possibly compiled) network
+    :return: the eager-mode network
+    """
+    return getattr(net, '_orig_mod', net)
 
 
 def evaluate(model: ContinualModel, dataset: ContinualDataset, last=False) -> Tuple[list, list]:
@@ -49,64 +115,85 @@ def evaluate(model: ContinualModel, dataset: ContinualDataset, last=False) -> Tu
     status = model.net.training
     model.net.eval()
     #cl_saliency_model
-    if hasattr(model, 'saliency_net'):
+    has_sal = hasattr(model, 'saliency_net')
+    if has_sal:
         sal_status = model.saliency_net.training
         model.saliency_net.eval()
-    
+
+    # hoist per-batch attribute lookups out of the hot loop
+    device = model.device
+    setting = dataset.SETTING
+    is_class_il = 'class-il' in model.COMPATIBILITY
+    channels_last = torch.cuda.is_available()
+
     accs, accs_mask_classes = [], []
-    sal_scores = []
-    for k, test_loader in enumerate(dataset.test_loaders):
-        if last and k < len(dataset.test_loaders) - 1:
-            continue
-        correct, correct_mask_classes, total = 0.0, 0.0, 0.0
-        for data in test_loader:
-            with torch.no_grad():
+    # running per-metric sums, reduced on device instead of a Python list
+    sal_running = torch.zeros(3, device=device)
+    sal_count = 0
+    gpu_residency = getattr(model.args, 'gpu_residency', False) and torch.cuda.is_available()
+    amp_ctx = torch.autocast('cuda', dtype=torch.bfloat16) \
+        if getattr(model.args, 'amp', False) else contextlib.nullcontext()
+    # a single inference_mode block also skips view tracking, unlike no_grad
+    with torch.inference_mode():
+        for k, test_loader in enumerate(dataset.test_loaders):
+            if last and k < len(dataset.test_loaders) - 1:
+                continue
+            if gpu_residency:
+                test_loader = dataset.test_loaders[k] = \
+                    gpu_resident_loader(test_loader, device, shuffle=False)
+            # accumulate counts on device, syncing with .item() only once per task
+            correct = torch.zeros((), dtype=torch.long, device=device)
+            correct_mask_classes = torch.zeros((), dtype=torch.long, device=device)
+            total = 0
+            for data in maybe_prefetch(test_loader, device):
                 inputs, labels = data
                 if isinstance(inputs, list):
-                    inputs = [inp.to(model.device) for inp in inputs]
+                    inputs = [inp.to(device, non_blocking=True) for inp in inputs]
                 else:
-                    inputs = inputs.to(model.device)
-                labels = labels.to(model.device)
-
-                if hasattr(model, 'saliency_net'):
-                    if 'class-il' not in model.COMPATIBILITY:
-                        sal_preds, outputs = model(inputs, k)
+                    inputs = inputs.to(device, non_blocking=True)
+                if channels_last:
+                    inputs = to_channels_last(inputs)
+                labels = labels.to(device, non_blocking=True)
+
+                with amp_ctx:
+                    if has_sal:
+                        if not is_class_il:
+                            sal_preds, outputs = model(inputs, k)
+                        else:
+                            sal_preds, outputs = model(inputs)
                     else:
-                        sal_preds, outputs = model(inputs)
-                else:    
-                    if 'class-il' not in model.COMPATIBILITY:
-                        outputs = model(inputs, k)
-                    else:
-                        outputs = model(inputs)
+                        if not is_class_il:
+                            outputs = model(inputs, k)
+                        else:
+                            outputs = model(inputs)
 
-                _, pred = torch.max(outputs.data, 1)
-                correct += torch.sum(pred == labels).item()
+                correct += (outputs.argmax(1) == labels).sum()
                 total += labels.shape[0]
 
-                if hasattr(model, 'saliency_net'):
+                if has_sal:
                     assert isinstance(inputs, list)
                     #compute saliency metrics
-                    sal_metrics = compute_saliency_metrics(sal_preds, inputs[1], metrics = ('kld', 'cc', 'sim'))
-                    sal_scores.append(sal_metrics)
+                    # the metrics go through numpy, which has no bfloat16
+                    sal_metrics = compute_saliency_metrics(sal_preds.float(), inputs[1], metrics = ('kld', 'cc', 'sim'))
+                    sal_running += torch.stack([m.float().sum().to(device) for m in sal_metrics])
+                    sal_count += labels.shape[0]
 
-                if dataset.SETTING == 'class-il':
-                    mask_classes(outputs, dataset, k)
-                    _, pred = torch.max(outputs.data, 1)
-                    correct_mask_classes += torch.sum(pred == labels).item()
+                if setting == 'class-il':
+                    # out-of-place mask: raw and task-il argmax read the
+                    # same outputs, fusable into one kernel when compiled
+                    mask = get_task_mask(dataset, k, outputs.device)
+                    masked = outputs[:, :mask.shape[0]].masked_fill(mask, -float('inf'))
+                    correct_mask_classes += (masked.argmax(1) == labels).sum()
 
-        accs.append(correct / total * 100
-                    if 'class-il' in model.COMPATIBILITY else 0)
-        accs_mask_classes.append(correct_mask_classes / total * 100)
-        
-        if hasattr(model, 'saliency_net'):
-            final_sal_scores = []
-            for m_index in range(len(sal_scores[0])):
-                values = [s[m_index] for s in sal_scores]
-                values = torch.cat(values)
-                final_sal_scores.append(torch.mean(values).item())
+            accs.append(correct.item() / total * 100
+                        if is_class_il else 0)
+            accs_mask_classes.append(correct_mask_classes.item() / total * 100)
+
+            if has_sal:
+                final_sal_scores = (sal_running / sal_count).tolist()
 
     model.net.train(status)
-    if hasattr(model, 'saliency_net'):
+    if has_sal:
         model.saliency_net.train(sal_status)
         return accs, accs_mask_classes, final_sal_scores
 
@@ -131,6 +218,31 @@ def train(model: ContinualModel, dataset: ContinualDataset,
     model.net.to(model.device) # model.net
     if hasattr(model, 'saliency_net'):
         model.saliency_net.to(model.device)
+    if torch.cuda.is_available():
+        # shapes are fixed within a task, so cudnn autotuning pays off;
+        # TF32 and channels-last speed up the conv backbones on Ampere+
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.backends.cudnn.benchmark = True
+        model.net = model.net.to(memory_format=torch.channels_last)
+        if hasattr(model, 'saliency_net'):
+            model.saliency_net = model.saliency_net.to(memory_format=torch.channels_last)
+    # checkpoints are loaded at model construction, so it is safe to compile here
+    if getattr(args, 'compile', False):
+        # warm the Inductor cache so repeated runs skip the cold compile;
+        # keyed on model + dataset so every run probes the same directory
+        cache_dir = f'data/results/inductor_cache/{args.model}_{args.dataset}'
+        os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', cache_dir)
+        os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+        artifact_path = os.path.join(cache_dir, 'artifact.bin')
+        if hasattr(torch.compiler, 'load_cache_artifacts') and os.path.exists(artifact_path):
+            with open(artifact_path, 'rb') as f:
+                torch.compiler.load_cache_artifacts(f.read())
+        model.net = torch.compile(model.net, mode='reduce-overhead',
+                                  fullgraph=False, dynamic=False)
+        if hasattr(model, 'saliency_net'):
+            model.saliency_net = torch.compile(model.saliency_net, mode='reduce-overhead',
+                                               fullgraph=False, dynamic=False)
     results, results_mask_classes = [], []
 
     if not args.disable_log:
@@ -138,57 +250,79 @@ def train(model: ContinualModel, dataset: ContinualDataset,
 
     progress_bar = ProgressBar(verbose=not args.non_verbose)
 
-    if not args.ignore_other_metrics:
-        dataset_copy = get_dataset(args)
-        for t in range(dataset.N_TASKS):
-            model.net.train()
-            _, _ = dataset_copy.get_data_loaders()
+    # bf16 autocast needs no GradScaler, unlike fp16
+    amp_ctx = torch.autocast('cuda', dtype=torch.bfloat16) \
+        if getattr(args, 'amp', False) else contextlib.nullcontext()
+
+    # single writer thread: checkpoint I/O overlaps the next task's training
+    save_pool = ThreadPoolExecutor(max_workers=1) if args.savecheck else None
+    save_futures = []
+
+    device = model.device
+    setting = dataset.SETTING
+    prog_interval = max(getattr(args, 'prog_interval', 1), 1)
+    channels_last = torch.cuda.is_available()
 
     print(file=sys.stderr)
     for t in range(dataset.N_TASKS):
         model.net.train()
         train_loader, test_loader = dataset.get_data_loaders()
+        if getattr(args, 'gpu_residency', False) and torch.cuda.is_available():
+            train_loader = gpu_resident_loader(train_loader, device, shuffle=True)
+        else:
+            train_loader = maybe_prefetch(train_loader, device)
         if hasattr(model, 'begin_task'):
             model.begin_task(dataset) # call the begin_task method of the model
 
         if t and not args.ignore_other_metrics:
             accs = evaluate(model, dataset, last=True)
             results[t-1] = results[t-1] + accs[0]
-            if dataset.SETTING == 'class-il':
+            if setting == 'class-il':
                 results_mask_classes[t-1] = results_mask_classes[t-1] + accs[1]
 
         scheduler = dataset.get_scheduler(model, args)
-        print(f"Task: {t+1}; num_images: {len(train_loader.dataset.data)}")        
+        print(f"Task: {t+1}; num_images: {len(train_loader.dataset.data)}")
+        # hoist per-batch attribute lookups out of the hot loop
+        has_logits = hasattr(dataset.train_loader.dataset, 'logits')
+        n_iters = len(train_loader)
         for epoch in range(model.args.n_epochs):
             if args.model == 'joint':
                 continue
             for i, data in enumerate(train_loader):
                 if args.debug_mode and i > 3:
                     break
-                if hasattr(dataset.train_loader.dataset, 'logits'):
+                if has_logits:
                     inputs, labels, not_aug_inputs, logits = data
                     if isinstance(inputs, list):
-                        inputs = [inp.to(model.device) for inp in inputs]
+                        inputs = [inp.to(device, non_blocking=True) for inp in inputs]
                     else:
-                        inputs = inputs.to(model.device)  
-                    labels = labels.to(model.device)
-                    not_aug_inputs = not_aug_inputs.to(model.device)
-                    logits = logits.to(model.device)
-                    loss = model.meta_observe(inputs, labels, not_aug_inputs, logits) # call the meta_observe method of the model
+                        inputs = inputs.to(device, non_blocking=True)
+                    if channels_last:
+                        inputs = to_channels_last(inputs)
+                    labels = labels.to(device, non_blocking=True)
+                    not_aug_inputs = not_aug_inputs.to(device, non_blocking=True)
+                    logits = logits.to(device, non_blocking=True)
+                    with amp_ctx:
+                        loss = model.meta_observe(inputs, labels, not_aug_inputs, logits) # call the meta_observe method of the model
                 else:
                     inputs, labels, not_aug_inputs = data
                     if isinstance(inputs, list):
-                        inputs = [inp.to(model.device) for inp in inputs]
+                        inputs = [inp.to(device, non_blocking=True) for inp in inputs]
+                    else:
+                        inputs = inputs.to(device, non_blocking=True)
+                    if channels_last:
+                        inputs = to_channels_last(inputs)
+                    labels = labels.to(device, non_blocking=True)
+                    not_aug_inputs = not_aug_inputs.to(device, non_blocking=True)
+                    with amp_ctx:
+                        loss = model.meta_observe(inputs, labels, not_aug_inputs)
+                # only inspect the loss every prog_interval iterations
+                if i % prog_interval == 0 or i == n_iters - 1:
+                    if isinstance(loss, list):
+                        assert not math.isnan(loss[0])
                     else:
-                        inputs = inputs.to(model.device)    
-                    labels = labels.to(model.device)
-                    not_aug_inputs = not_aug_inputs.to(model.device)
-                    loss = model.meta_observe(inputs, labels, not_aug_inputs)
-                if isinstance(loss, list):  
-                    assert not math.isnan(loss[0])
-                else: 
-                    assert not math.isnan(loss)
-                progress_bar.prog(i, len(train_loader), epoch, t, loss)
+                        assert not math.isnan(loss)
+                    progress_bar.prog(i, n_iters, epoch, t, loss)
 
             if scheduler is not None:
                 scheduler.step()
@@ -210,7 +344,7 @@ def train(model: ContinualModel, dataset: ContinualDataset,
             sal_metrics = [0., 0., 0.]
 
         mean_acc = np.mean(accs, axis=1)
-        print_mean_accuracy(mean_acc, t + 1, dataset.SETTING)
+        print_mean_accuracy(mean_acc, t + 1, setting)
 
         if not args.disable_log:
             logger.log(mean_acc)
@@ -219,34 +353,59 @@ def train(model: ContinualModel, dataset: ContinualDataset,
         if not args.nowand:
             d2={'RESULT_class_mean_accs': mean_acc[0], 'RESULT_task_mean_accs': mean_acc[1],
                 'kld':sal_metrics[0], 'cc':sal_metrics[1], 'sim':sal_metrics[2],
-                **{f'RESULT_class_acc_{i}': a for i, a in enumerate(accs[0])},
-                **{f'RESULT_task_acc_{i}': a for i, a in enumerate(accs[1])}}
+                **dict(zip([f'RESULT_class_acc_{i}' for i in range(len(accs[0]))], accs[0])),
+                **dict(zip([f'RESULT_task_acc_{i}' for i in range(len(accs[1]))], accs[1]))}
             if hasattr(model, 'saliency_net'):
                 if hasattr(model, 'saliency_scheduler') and model.saliency_scheduler is not None:
                     lr = model.saliency_opt.param_groups[0]['lr']
                     d2.update({'sal_lr':lr})
-            wandb.log(d2)
+            # buffer intermediate task logs client-side, flush on the last task;
+            # step=t keeps each task's metrics on its own step while uncommitted
+            wandb.log(d2, step=t, commit=(t == dataset.N_TASKS - 1))
         
         if args.savecheck:
             print(f"Saving checkpoint into: data/results/{args.ckpt_name}")
             create_if_not_exists(f'data/results/{args.ckpt_name}')
             # model
-            torch.save(model.net.state_dict(), f'data/results/{args.ckpt_name}/{args.ckpt_name}_{t}.pt')
+            # snapshot everything to CPU synchronously, then hand the file
+            # writes to the saver thread so they overlap the next task
+            # copy=True so CPU runs snapshot the weights instead of aliasing them
+            net_state = {key: v.detach().to('cpu', copy=True) for key, v in uncompiled(model.net).state_dict().items()}
+            save_futures.append(save_pool.submit(
+                torch.save, net_state, f'data/results/{args.ckpt_name}/{args.ckpt_name}_{t}.pt'))
             # saliency_net (if exists)
             if hasattr(model, 'saliency_net'):
-                torch.save(model.saliency_net.state_dict(), f'data/results/{args.ckpt_name}/{args.ckpt_name}_sal_model_{t}.pt')
-            if 'buffer_size' in model.args:
-                with open(f'data/results/{args.ckpt_name}/{args.ckpt_name_replace.format("bufferoni")}_{t}.pkl', 'wb') as f:
-                    pickle.dump(obj=deepcopy(model.buffer).to('cpu'), file=f)
-            with open(f'data/results/{args.ckpt_name}/{args.ckpt_name_replace.format("interpr")}_{t}.pkl', 'wb') as f:
-                pickle.dump(obj=args, file=f)
-            
-            with open(f'data/results/{args.ckpt_name}/{args.ckpt_name_replace.format("results")}_{t}.pkl', 'wb') as f:
-                pickle.dump(obj=[
-                    results, 
-                    results_mask_classes, 
+                sal_state = {key: v.detach().to('cpu', copy=True) for key, v in uncompiled(model.saliency_net).state_dict().items()}
+                save_futures.append(save_pool.submit(
+                    torch.save, sal_state, f'data/results/{args.ckpt_name}/{args.ckpt_name}_sal_model_{t}.pt'))
+            # fuse buffer, args and results into one bundle: a single
+            # open/fsync and torch's fast tensor serializer for the buffer
+            buffer_cpu = buffer_state_dict(model.buffer) if 'buffer_size' in model.args else None
+            save_futures.append(save_pool.submit(torch.save, {
+                'buffer': buffer_cpu,
+                'args': args,
+                # the logger and results keep growing across tasks, so
+                # save per-task copies rather than the live lists
+                'results': [
+                    [list(r) for r in results],
+                    [list(r) for r in results_mask_classes],
                     sal_metrics,
-                    logger.dump()], file=f)
+                    deepcopy(logger.dump())]},
+                f'data/results/{args.ckpt_name}/{args.ckpt_name_replace.format("bundle")}_{t}.pt'))
+
+    if getattr(args, 'compile', False) and hasattr(torch.compiler, 'save_cache_artifacts'):
+        artifacts = torch.compiler.save_cache_artifacts()
+        if artifacts is not None:
+            create_if_not_exists(cache_dir)
+            with open(artifact_path, 'wb') as f:
+                f.write(artifacts[0])
+
+    if save_pool is not None:
+        save_pool.shutdown(wait=True)
+        # re-raise any serialization failure instead of finishing
+        # a run that silently wrote no checkpoints
+        for future in save_futures:
+            future.result()
 
     if not args.disable_log and not args.ignore_other_metrics:
         logger.add_bwt(results, results_mask_classes)